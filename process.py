@@ -1,18 +1,19 @@
 from __future__ import annotations
 
-import json
 import logging
-from dataclasses import dataclass, asdict
+import time
+from collections import defaultdict
+from concurrent.futures import Future
 from enum import Enum
 from threading import Lock, Thread, Event
-from random import randint
+from random import randint, uniform
 
-from typing import Optional, Dict
+from typing import Optional, Dict, List, Set, Callable, Any, Iterable
 
 import rpyc
-from rpyc import Service
-from rpyc.utils.helpers import classpartial
-from rpyc.utils.server import ThreadedServer
+
+from process_core import LamportClock, Message, MESSAGE_TYPE_REQUEST, MESSAGE_TYPE_REPLY
+from process_socket import MessageServer, PeerLink
 
 logger = logging.getLogger(__name__)
 
@@ -23,86 +24,99 @@ class State(str, Enum):
     DO_NOT_WANT = "DO-NOT-WANT"
 
 
-class MessageType(str, Enum):
-    REQUEST = "REQUEST"
-    REPLY = "REPLY"
-
-
 T_LOWER = 5
-
-
-class LamportClock:
-    def __init__(self, time: int = 0):
-        self.time = time
-        self.lock = Lock()
-
-    def increment(self, new_time: int = 0):
-        with self.lock:
-            self.time = max(new_time, self.time) + 1
-            return self.time
+POOL_SIZE = 4
+BACKOFF_BASE = 0.1
+BACKOFF_MAX = 5.0
 
 
 class ResponseQueue:
     def __init__(self):
-        self.queue = set()
-        self.lock = Lock()
+        # latest deferred request per sender, a peer only waits for one reply from us
+        # dict item assignment and popitem are atomic, no lock needed
+        self.queue: Dict[int, Message] = {}
 
-    def add(self, item):
-        with self.lock:
-            self.queue.add(item)
+    def add(self, item: Message):
+        self.queue[item.sender_id] = item
 
-    def pop(self):
-        with self.lock:
-            return self.queue.pop()
+    def pop(self) -> Message:
+        return self.queue.popitem()[1]
 
     def __len__(self):
-        with self.lock:
-            return len(self.queue)
+        return len(self.queue)
 
 
 class Requests:
-    def __init__(self):
+    def __init__(self, done: Event):
         self.requests = set()
         self.lock = Lock()
+        # set exactly when there are no outstanding requests
+        self.done = done
+        self.done.set()
 
     def add(self, item):
         with self.lock:
             self.requests.add(item)
+            self.done.clear()
 
     def remove(self, item):
         with self.lock:
-            self.requests.remove(item)
+            # a reply to an abandoned request may still arrive, there is nothing to remove then
+            self.requests.discard(item)
+            if len(self.requests) == 0:
+                self.done.set()
 
-    def is_waiting(self):
+    def clear(self):
         with self.lock:
-            return len(self.requests) > 0
+            self.requests.clear()
+            self.done.set()
 
+    def is_waiting(self):
+        return not self.done.is_set()
 
-class ProcessService(Service):
-    def __init__(self, process: Process):
-        self.process = process
-
-    def exposed_message(self, message: str):
-        response = self.process.handle_message(Message.deserialize(message))
-        if isinstance(response, Message):
-            return response.serialize()
-        return response
-
+    def outstanding(self):
+        with self.lock:
+            return set(self.requests)
 
-@dataclass(frozen=True)
-class Message:
-    type: MessageType
-    sender_id: int
-    time: int
 
-    def serialize(self) -> str:
-        return json.dumps(asdict(self))
+class ConnectionPool:
+    def __init__(self, connect: Callable[[str, int], Any], host: str = "localhost", size: int = POOL_SIZE):
+        # connect(host, port) must return an object with a `closed` attribute and a `close()` method
+        self.connect = connect
+        self.host = host
+        self.size = size
+        self.idle: Dict[int, List[Any]] = defaultdict(list)
+        self.lock = Lock()
 
-    @classmethod
-    def deserialize(cls, serialized: str) -> Message:
-        values = json.loads(serialized)
-        values["type"] = MessageType(values["type"])
-        return cls(**values)
+    def acquire(self, port: int) -> Any:
+        with self.lock:
+            idle = self.idle[port]
+            while len(idle) > 0:
+                conn = idle.pop()
+                if not conn.closed:
+                    return conn
+        return self.connect(self.host, port)
+
+    def release(self, port: int, conn: Any):
+        if not conn.closed:
+            with self.lock:
+                idle = self.idle[port]
+                if len(idle) < self.size:
+                    idle.append(conn)
+                    return
+            conn.close()
+
+    def call(self, port: int, func: Callable[[Any], Any]) -> Any:
+        conn = self.acquire(port)
+        try:
+            return func(conn)
+        except (EOFError, ConnectionError):
+            # pooled connection went stale (e.g. peer restarted), retry once on a fresh one
+            conn.close()
+            conn = self.connect(self.host, port)
+            return func(conn)
+        finally:
+            self.release(port, conn)
 
 
 class Process(Thread):
@@ -117,113 +131,212 @@ class Process(Thread):
         self._time = 5
 
         self.queue = ResponseQueue()
-        self.waiting = Requests()
+        self._all_replied = Event()
+        self.waiting = Requests(self._all_replied)
 
         self.id_to_port = id_to_port
 
         self.resource_port = resource_port
+        self.resource_connections = ConnectionPool(rpyc.connect)
 
         self.other_processes = set(self.id_to_port.keys()) - {self.id}
         if self.id not in self.id_to_port:
             raise Exception("Process id is missing from id to port map.")
 
+        self.links = {p: PeerLink("localhost", self.id_to_port[p]) for p in self.other_processes}
+
+        # Roucairol-Carvalho: a peer's reply stays valid until we reply to that peer in turn,
+        # so while nobody else asks for the resource it can be re-entered without any messages
+        self.lock = Lock()
+        self.permissions: Set[int] = set()
+        # peers asked for permission in the current request, None while not requesting
+        self.requested: Optional[Set[int]] = None
+        # error from a permission request sent from a server thread, raised by request_resource
+        self.failure: Optional[Exception] = None
+
     def set_time(self, t):
         if t < T_LOWER:
             raise Exception(f"Time must be greater or equal to {T_LOWER}.")
         self._time = t
 
-    def _send_message(self, message: Message, target_id: int) -> Optional[Message]:
-        with rpyc.connect("localhost", self.id_to_port[target_id]) as conn:
-            response = conn.root.message(message.serialize())
-            if isinstance(response, str):
-                return Message.deserialize(response)
-            return None
+    def _send_message(self, payload: bytes, target_ids: Iterable[int]) -> Dict[int, Optional[Message]]:
+        # queue the payload on every link first so that the peers are contacted concurrently
+        futures = {p: self.links[p].submit(payload) for p in target_ids}
+        responses = {}
+        for p, future in futures.items():
+            responses[p] = self._deserialize_response(future.result())
+        return responses
+
+    @staticmethod
+    def _deserialize_response(response: Optional[bytes]) -> Optional[Message]:
+        return Message.deserialize(response) if response is not None else None
+
+    def _request_permission(self, message: Message, p_id: int):
+        # called from server threads, so do not block on the peer's response
+        future = self.links[p_id].submit(message.serialize())
+        future.add_done_callback(lambda f: self._handle_permission_response(f, p_id))
+
+    def _handle_permission_response(self, future: Future, p_id: int):
+        error = future.exception()
+        if error is None:
+            self.handle_request_response(self._deserialize_response(future.result()), p_id)
+            return
+
+        logger.error("P%s could not request permission from P%s: %r", self.id, p_id, error)
+        with self.lock:
+            if self.requested is None or p_id not in self.requested:
+                # the request was already given up
+                return
+            self.requested.discard(p_id)
+            # entering without this peer's permission is not safe, so abandon the whole request;
+            # clearing wakes request_resource, which sees the failure before it could enter
+            self.failure = error
+            self.waiting.clear()
+
+    def handle_payload(self, payload: bytes) -> Optional[bytes]:
+        response = self.handle_message(Message.deserialize(payload))
+        if isinstance(response, Message):
+            return response.serialize()
+        return None
 
     def handle_request(self, message: Message) -> Optional[Message]:
-        self.clock.increment(message.time)
+        # receiving the request and sending the reply are two events, reserve both ticks in one update;
+        # if the request is deferred the reply tick is simply skipped, which lamport clocks allow
+        reply_time = self.clock.increment(message.time, 2)
 
-        if (
-                self.state == State.HELD or
-                (self.state == State.WANTED and
-                 (self.sent_message.time < message.time or
-                  # id timestamps are the same, using id to break the tie
-                  (self.sent_message.time == message.time and self.id < message.sender_id)
-                 )
-                )
-        ):
-            logger.info(f"P{self.id} ignoring request")
-            self.queue.add(message)
-            return None
-
-        reply = Message(MessageType.REPLY, self.id, self.clock.increment())
-        logger.info(f"P{self.id} replying with {reply}")
+        with self.lock:
+            if (
+                    self.state == State.HELD or
+                    (self.state == State.WANTED and
+                     (self.sent_message.time < message.time or
+                      # id timestamps are the same, using id to break the tie
+                      (self.sent_message.time == message.time and self.id < message.sender_id)
+                     )
+                    )
+            ):
+                logger.info("P%s ignoring request", self.id)
+                self.queue.add(message)
+                return None
+
+            # replying hands our permission over, if we are requesting without having asked this peer we must now
+            self.permissions.discard(message.sender_id)
+            request = None
+            if self.requested is not None and message.sender_id not in self.requested:
+                self.requested.add(message.sender_id)
+                self.waiting.add(message.sender_id)
+                request = self.sent_message
+
+        if request is not None:
+            self._request_permission(request, message.sender_id)
+
+        reply = Message(MESSAGE_TYPE_REPLY, self.id, reply_time)
+        logger.info("P%s replying with %s", self.id, reply)
         return reply
 
     def handle_reply(self, message: Message):
         self.clock.increment(message.time)
-        self.waiting.remove(message.sender_id)
+        with self.lock:
+            self.permissions.add(message.sender_id)
+            self.waiting.remove(message.sender_id)
 
     def handle_message(self, message: Message) -> Optional[Message]:
-        logger.info(f"P{self.id} received message {message}")
-        if message.type == MessageType.REQUEST:
+        logger.info("P%s received message %s", self.id, message)
+        if message.type is MESSAGE_TYPE_REQUEST:
             return self.handle_request(message)
-        elif message.type == MessageType.REPLY:
+        elif message.type is MESSAGE_TYPE_REPLY:
             return self.handle_reply(message)
         else:
             raise Exception("Unknown message type")
 
-    def send_request_message(self, message: Message, p_id: int):
-        response = self._send_message(message, p_id)
-        logger.info(f"P{self.id} received reply {response}")
-        if response is None:
-            self.waiting.add(p_id)
-        else:
+    def handle_request_response(self, response: Optional[Message], p_id: int):
+        logger.info("P%s received reply %s", self.id, response)
+        if response is not None:
             self.clock.increment(response.time)
+            with self.lock:
+                self.permissions.add(p_id)
+                self.waiting.remove(p_id)
 
     def request_resource(self):
         if self.state != State.DO_NOT_WANT:
             raise Exception("Incorrect state")
 
-        msg = Message(MessageType.REQUEST, self.id, self.clock.increment())
-        self.sent_message = msg
-        self.state = State.WANTED
-
-        for p in self.other_processes:
-            self.send_request_message(msg, p)
-
-        while self.waiting.is_waiting():
-            pass
+        with self.lock:
+            msg = Message(MESSAGE_TYPE_REQUEST, self.id, self.clock.increment())
+            self.sent_message = msg
+            self.state = State.WANTED
+
+            targets = self.other_processes - self.permissions
+            self.requested = set(targets)
+            # register every peer before sending, a deferred reply may arrive before its request returns
+            for p in targets:
+                self.waiting.add(p)
+
+        try:
+            if len(targets) > 0:
+                for p, response in self._send_message(msg.serialize(), targets).items():
+                    self.handle_request_response(response, p)
+            else:
+                logger.info("P%s holds all permissions, skipping requests", self.id)
+
+            # replies wake us up through the event, the jittered timeout only paces the progress logging
+            attempt = 0
+            while True:
+                delay = min(BACKOFF_BASE * 2 ** attempt, BACKOFF_MAX)
+                replied = self._all_replied.wait(uniform(delay / 2, delay))
+                with self.lock:
+                    if self.failure is not None:
+                        error, self.failure = self.failure, None
+                        raise error
+                    # a peer may have taken its permission back in the meantime
+                    if replied and not self.waiting.is_waiting():
+                        self.state = State.HELD
+                        return
+                if replied:
+                    continue
+
+                # stop growing once capped, the exponent would eventually overflow the float conversion
+                if delay < BACKOFF_MAX:
+                    attempt += 1
+                # outstanding() takes the lock, only call it when the message is actually emitted
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info("P%s still waiting for replies from %s", self.id, self.waiting.outstanding())
+        except Exception:
+            # give up the request, otherwise the peers deferred to us would wait for our reply forever
+            self.free_resource()
+            raise
 
     def use_resource(self):
-        self.state = State.HELD
-        with rpyc.connect("localhost", self.resource_port) as conn:
-            return conn.root.use()
+        return self.resource_connections.call(self.resource_port, lambda conn: conn.root.use())
 
     def free_resource(self):
-        self.state = State.DO_NOT_WANT
-        self.sent_message = None
+        with self.lock:
+            self.state = State.DO_NOT_WANT
+            self.sent_message = None
+            self.requested = None
+            self.waiting.clear()
 
-        if len(self.queue) > 0:
-            reply_message = Message(MessageType.REPLY, self.id, self.clock.increment())
+            targets = []
             while len(self.queue) > 0:
-                message = self.queue.pop()
-                self._send_message(reply_message, message.sender_id)
+                targets.append(self.queue.pop().sender_id)
+            self.permissions.difference_update(targets)
+
+        if len(targets) > 0:
+            payload = Message(MESSAGE_TYPE_REPLY, self.id, self.clock.increment()).serialize()
+            self._send_message(payload, targets)
 
     def _start_server(self):
-        logger.info(f"P{self.id} starting server with port {self.id_to_port[self.id]}")
-        service = classpartial(ProcessService, self)
-        server = ThreadedServer(service, port=self.id_to_port[self.id])
-        thread = Thread(target=server.start)
-        thread.daemon = True
-        thread.start()
+        logger.info("P%s starting server with port %s", self.id, self.id_to_port[self.id])
+        server = MessageServer(self.id_to_port[self.id], self.handle_payload)
+        # serve_forever() blocks in the accept loop, the process thread itself runs the request cycle
+        Thread(target=server.serve_forever, daemon=True).start()
 
     def run(self):
         self._start_server()
         while True:
-            Event().wait(randint(T_LOWER, self._time))
-            logger.info(f"P{self.id} requesting resource")
+            time.sleep(randint(T_LOWER, self._time))
+            logger.info("P%s requesting resource", self.id)
             self.request_resource()
-            logger.info(f"P{self.id} using resource")
+            logger.info("P%s using resource", self.id)
             self.use_resource()
-            logger.info(f"P{self.id} freeing resource")
+            logger.info("P%s freeing resource", self.id)
             self.free_resource()
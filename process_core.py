@@ -0,0 +1,53 @@
+from __future__ import annotations
+
+import struct
+from enum import Enum
+from threading import Lock
+from typing import NamedTuple
+
+# Per-message hot path, kept free of rpyc and socket code so that it can be compiled on its own
+# with `mypyc process_core.py`, an existing compiled module is picked up by `import process_core`.
+
+
+class MessageType(str, Enum):
+    REQUEST = "REQUEST"
+    REPLY = "REPLY"
+
+
+# wire format: type code, sender id, lamport time
+MESSAGE_FORMAT = struct.Struct("!BqQ")
+MESSAGE_TYPES = tuple(MessageType)
+# cached members, looking them up on the enum class on every message is comparatively slow
+MESSAGE_TYPE_REQUEST = MessageType.REQUEST
+MESSAGE_TYPE_REPLY = MessageType.REPLY
+MESSAGE_TYPE_CODES = {message_type: code for code, message_type in enumerate(MESSAGE_TYPES)}
+
+
+class LamportClock:
+    def __init__(self, time: int = 0):
+        self.time = time
+        self.lock = Lock()
+
+    def increment(self, new_time: int = 0, ticks: int = 1) -> int:
+        with self.lock:
+            time = self.time
+            if new_time > time:
+                time = new_time
+            time += ticks
+            self.time = time
+            return time
+
+
+class Message(NamedTuple):
+    type: MessageType
+    sender_id: int
+    time: int
+
+    def serialize(self) -> bytes:
+        message_type, sender_id, time = self
+        return MESSAGE_FORMAT.pack(MESSAGE_TYPE_CODES[message_type], sender_id, time)
+
+    @classmethod
+    def deserialize(cls, serialized: bytes) -> Message:
+        type_code, sender_id, time = MESSAGE_FORMAT.unpack(serialized)
+        return cls(MESSAGE_TYPES[type_code], sender_id, time)
@@ -0,0 +1,130 @@
+import logging
+import socket
+import struct
+from concurrent.futures import Future
+from queue import SimpleQueue
+from socketserver import BaseRequestHandler, ThreadingTCPServer
+from threading import Thread
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+# every frame is prefixed with the length of its payload
+FRAME_HEADER = struct.Struct("!H")
+# response frames start with a status byte, followed by the response or the error text
+RESPONSE_NONE = b"\x00"
+RESPONSE_OK = b"\x01"
+RESPONSE_ERROR = b"\x02"
+MAX_ERROR_LENGTH = 1024
+
+
+class RemoteError(Exception):
+    pass
+
+
+def _recv_exactly(sock: socket.socket, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError("Connection closed by peer")
+        data += chunk
+    return bytes(data)
+
+
+def send_frame(sock: socket.socket, payload: bytes):
+    sock.sendall(FRAME_HEADER.pack(len(payload)) + payload)
+
+
+def recv_frame(sock: socket.socket) -> bytes:
+    size, = FRAME_HEADER.unpack(_recv_exactly(sock, FRAME_HEADER.size))
+    return _recv_exactly(sock, size)
+
+
+class MessageConnection:
+    def __init__(self, host: str, port: int):
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.closed = False
+
+    def call(self, payload: bytes) -> Optional[bytes]:
+        try:
+            send_frame(self.sock, payload)
+            response = recv_frame(self.sock)
+        except (EOFError, OSError):
+            # the stream may be out of sync now, it can not be reused
+            self.close()
+            raise
+
+        status, body = response[:1], response[1:]
+        if status == RESPONSE_ERROR:
+            # the peer did process the message, so this must not look like a dead connection
+            raise RemoteError(body.decode(errors="replace"))
+        return body if status == RESPONSE_OK else None
+
+    def close(self):
+        self.closed = True
+        self.sock.close()
+
+
+class PeerLink:
+    # one connection per peer, written to only by the link's own thread
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.connection: Optional[MessageConnection] = None
+        self.queue = SimpleQueue()
+        self.thread = Thread(target=self._drain, daemon=True)
+        self.thread.start()
+
+    def submit(self, payload: bytes) -> Future:
+        future = Future()
+        self.queue.put((payload, future))
+        return future
+
+    def _call(self, payload: bytes) -> Optional[bytes]:
+        if self.connection is None or self.connection.closed:
+            self.connection = MessageConnection(self.host, self.port)
+        return self.connection.call(payload)
+
+    def _drain(self):
+        while True:
+            payload, future = self.queue.get()
+            try:
+                try:
+                    response = self._call(payload)
+                except (EOFError, ConnectionError):
+                    # connection went stale (e.g. peer restarted), retry once on a fresh one
+                    response = self._call(payload)
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(response)
+
+
+class MessageHandler(BaseRequestHandler):
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        while True:
+            try:
+                payload = recv_frame(self.request)
+            except (EOFError, ConnectionError):
+                return
+            try:
+                response = self.server.handle_payload(payload)
+            except Exception as e:
+                logger.exception("Failed to handle message")
+                send_frame(self.request, RESPONSE_ERROR + repr(e).encode()[:MAX_ERROR_LENGTH])
+                continue
+            send_frame(self.request, RESPONSE_OK + response if response is not None else RESPONSE_NONE)
+
+
+class MessageServer(ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port: int, handle_payload: Callable[[bytes], Optional[bytes]]):
+        self.handle_payload = handle_payload
+        super().__init__(("", port), MessageHandler)
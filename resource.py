@@ -1,5 +1,6 @@
 import logging
-from threading import Lock, Thread, Event
+import time
+from threading import Lock, Thread
 from random import randint
 
 from rpyc import Service, ThreadedServer
@@ -28,7 +29,7 @@ class Resource(Thread):
         self._time = t
 
     def run(self):
-        logger.info(f"Resource is starting a server with port {self.port}")
+        logger.info("Resource is starting a server with port %s", self.port)
         service = classpartial(ResourceService, self)
         ThreadedServer(service, port=self.port).start()
 
@@ -36,10 +37,14 @@ class Resource(Thread):
 class ResourceService(Service):
     def __init__(self, resource: Resource):
         self.resource = resource
+        # each resource guards itself, services of different resources never share a lock
+        self._lock = resource.lock
 
     def exposed_use(self):
-        if self.resource.lock.locked():
+        if not self._lock.acquire(blocking=False):
             raise Exception("Resource already in use")
 
-        with self.resource.lock:
-            Event().wait(randint(T_LOWER, self.resource.time))
+        try:
+            time.sleep(randint(T_LOWER, self.resource.time))
+        finally:
+            self._lock.release()